@@ -3,7 +3,7 @@
 Gate.io 成交记录查询与持仓均价统计
 
 功能：
-1. 查询现货和理财账户的所有成交记录，缓存到本地CSV
+1. 查询现货和理财账户的所有成交记录，缓存到本地 Parquet 文件
 2. 增量更新新的成交记录
 3. 计算每个币种的买入均价
 
@@ -11,13 +11,24 @@ Gate.io 成交记录查询与持仓均价统计
 因此需要按30天为单位分段回溯查询。
 """
 
+import functools
+import json
 import os
+import random
+import shutil
 import sys
+import threading
 import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 from dotenv import load_dotenv
 import gate_api
 from gate_api.exceptions import ApiException, GateApiException
@@ -28,8 +39,46 @@ load_dotenv()
 # 项目路径配置
 PROJECT_DIR = Path(__file__).parent
 DATA_DIR = PROJECT_DIR / "data"
-TRADES_CSV = DATA_DIR / "trades.csv"
-DAILY_STATS_CSV = DATA_DIR / "daily_stats.csv"
+# 成交记录按月分区存储：trades/year=YYYY/month=MM/part-0.parquet
+TRADES_DIR = DATA_DIR / "trades"
+# 每日统计按日期分区存储：daily_stats/date=YYYY-MM-DD/part-0.parquet
+DAILY_STATS_DIR = DATA_DIR / "daily_stats"
+# 检查点：记录最早/最晚成交时间，删除缓存后全量拉取时可直接回溯到最早成交时间
+CHECKPOINT_JSON = DATA_DIR / "checkpoint.json"
+# 旧版本使用的缓存文件，首次运行时自动迁移
+LEGACY_TRADES_FILES = (DATA_DIR / "trades.parquet", DATA_DIR / "trades.csv")
+LEGACY_DAILY_STATS_FILES = (DATA_DIR / "daily_stats.parquet", DATA_DIR / "daily_stats.csv")
+# Parquet 压缩算法
+PARQUET_COMPRESSION = "zstd"
+# 成交记录的分区字段（UTC 年月，补零后按字符串排序即为时间顺序）
+TRADES_PARTITION_SCHEMA = pa.schema([("year", pa.string()), ("month", pa.string())])
+# 成交记录的存储结构
+# create_time 用 uint32 存秒级时间戳（可表示到2106年）；
+# 数量、价格、手续费保持 float64，float32 只有约7位有效数字，会影响均价精度
+TRADES_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("source", pa.dictionary(pa.int8(), pa.string())),
+    ("create_time", pa.uint32()),
+    ("create_time_ms", pa.int64()),
+    ("currency_pair", pa.string()),
+    ("base_currency", pa.dictionary(pa.int16(), pa.string())),
+    ("quote_currency", pa.dictionary(pa.int16(), pa.string())),
+    ("side", pa.dictionary(pa.int8(), pa.string())),
+    ("role", pa.dictionary(pa.int8(), pa.string())),
+    ("amount", pa.float64()),
+    ("price", pa.float64()),
+    ("order_id", pa.string()),
+    ("fee", pa.float64()),
+    ("fee_currency", pa.dictionary(pa.int16(), pa.string())),
+])
+# 计算均价需要的列
+ANALYSIS_COLUMNS = ["side", "base_currency", "quote_currency", "fee_currency", "amount", "price", "fee"]
+# 记录数达到该值且安装了 numba 时，使用编译后的手续费调整内核（JIT 编译本身有开销）
+NUMBA_MIN_ROWS = 1_000_000
+# 低基数的字符串列，使用 category 类型存储
+CATEGORY_COLUMNS = ("source", "side", "role")
+# 币种列共用同一组类别，编码可以直接相互比较
+CURRENCY_COLUMNS = ("base_currency", "quote_currency", "fee_currency")
 
 # 确保数据目录存在
 DATA_DIR.mkdir(exist_ok=True)
@@ -38,6 +87,40 @@ DATA_DIR.mkdir(exist_ok=True)
 QUERY_WINDOW_DAYS = 30
 # 连续多少天没有记录就停止回溯
 STOP_EMPTY_DAYS = 30
+# 并发查询的线程数（Gate 私有接口有频率限制，不宜过大）
+FETCH_CONCURRENCY = 5
+# 客户端限流：每秒请求数和突发容量
+RATE_LIMIT_PER_SECOND = 15
+RATE_LIMIT_BURST = 30
+# 触发 429 限流后的最大重试次数
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    """线程安全的令牌桶限流器"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """获取一个令牌，令牌不足时阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                
+                wait = (1 - self._tokens) / self.rate
+            
+            time.sleep(wait)
 
 
 class GateTradeClient:
@@ -59,16 +142,45 @@ class GateTradeClient:
         self._api_client = gate_api.ApiClient(configuration)
         self._spot_api = gate_api.SpotApi(self._api_client)
         self._earn_api = gate_api.EarnUniApi(self._api_client)
+        self._rate_limiter = TokenBucket(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+    
+    def _call_api(self, method, **kwargs):
+        """
+        调用 API，先经过令牌桶限流
+        
+        遇到 429 限流时按 Retry-After（缺省为指数退避）加随机抖动后重试
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            self._rate_limiter.acquire()
+            try:
+                return method(**kwargs)
+            except (ApiException, GateApiException) as e:
+                rate_limited = getattr(e, "status", None) == 429 or getattr(e, "label", None) == "TOO_MANY_REQUESTS"
+                if not rate_limited or attempt == MAX_RETRIES:
+                    raise
+                
+                # Retry-After 也可能是 HTTP 日期格式，无法解析时使用指数退避
+                retry_after = (getattr(e, "headers", None) or {}).get("Retry-After")
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    delay = 2 ** attempt
+                time.sleep(delay + random.uniform(0, 0.5))
     
-    def _fetch_spot_trades_in_range(self, from_ts: int, to_ts: int) -> list[dict]:
+    def _fetch_spot_trades_in_range(self, from_ts: int, to_ts: int) -> pd.DataFrame:
         """获取指定时间范围内的现货成交记录"""
-        all_trades = []
+        # 按列收集数据，最后一次性构建 DataFrame，避免逐行创建字典
+        ids, create_times, create_times_ms = [], [], []
+        currency_pairs, base_currencies, quote_currencies = [], [], []
+        sides, roles, amounts, prices = [], [], [], []
+        order_ids, fees, fee_currencies = [], [], []
         limit = 1000
         page = 1
         
         while True:
             try:
-                trades = self._spot_api.list_my_trades(
+                trades = self._call_api(
+                    self._spot_api.list_my_trades,
                     limit=limit,
                     page=page,
                     _from=from_ts,
@@ -79,46 +191,62 @@ class GateTradeClient:
                     break
                 
                 for trade in trades:
-                    all_trades.append({
-                        "id": f"spot_{trade.id}",
-                        "source": "spot",
-                        "create_time": int(float(trade.create_time)),
-                        "create_time_ms": int(float(trade.create_time_ms)) if trade.create_time_ms else int(float(trade.create_time)) * 1000,
-                        "currency_pair": trade.currency_pair,
-                        "base_currency": trade.currency_pair.split("_")[0],
-                        "quote_currency": trade.currency_pair.split("_")[1] if "_" in trade.currency_pair else "USDT",
-                        "side": trade.side,
-                        "role": trade.role,
-                        "amount": float(trade.amount),
-                        "price": float(trade.price),
-                        "order_id": trade.order_id,
-                        "fee": float(trade.fee) if trade.fee else 0,
-                        "fee_currency": trade.fee_currency,
-                    })
+                    create_time = int(float(trade.create_time))
+                    pair = trade.currency_pair
+                    parts = pair.split("_", 1)
+                    
+                    ids.append(f"spot_{trade.id}")
+                    create_times.append(create_time)
+                    create_times_ms.append(int(float(trade.create_time_ms)) if trade.create_time_ms else create_time * 1000)
+                    currency_pairs.append(pair)
+                    base_currencies.append(parts[0])
+                    quote_currencies.append(parts[1] if len(parts) > 1 else "USDT")
+                    sides.append(trade.side)
+                    roles.append(trade.role)
+                    amounts.append(float(trade.amount))
+                    prices.append(float(trade.price))
+                    order_ids.append(trade.order_id)
+                    fees.append(float(trade.fee) if trade.fee else 0.0)
+                    fee_currencies.append(trade.fee_currency)
                 
                 if len(trades) < limit:
                     break
                 
                 page += 1
-                time.sleep(0.05)
                 
             except (ApiException, GateApiException) as e:
                 if "INVALID_PARAM_VALUE" not in str(e):
                     print(f"    获取现货记录失败: {e}")
                 break
         
-        return all_trades
+        return pd.DataFrame({
+            "id": ids,
+            "source": "spot",
+            "create_time": np.asarray(create_times, dtype=np.int64),
+            "create_time_ms": np.asarray(create_times_ms, dtype=np.int64),
+            "currency_pair": currency_pairs,
+            "base_currency": base_currencies,
+            "quote_currency": quote_currencies,
+            "side": sides,
+            "role": roles,
+            "amount": np.asarray(amounts, dtype=np.float64),
+            "price": np.asarray(prices, dtype=np.float64),
+            "order_id": order_ids,
+            "fee": np.asarray(fees, dtype=np.float64),
+            "fee_currency": fee_currencies,
+        })
     
-    def _fetch_earn_records_in_range(self, from_ts: int, to_ts: int) -> list[dict]:
+    def _fetch_earn_records_in_range(self, from_ts: int, to_ts: int) -> pd.DataFrame:
         """获取指定时间范围内的理财记录"""
-        all_records = []
+        currencies, create_times_ms, amounts = [], [], []
         limit = 100
         page = 1
         
         # 理财API使用秒时间戳（返回的create_time是毫秒）
         while True:
             try:
-                records = self._earn_api.list_uni_lend_records(
+                records = self._call_api(
+                    self._earn_api.list_uni_lend_records,
                     limit=limit,
                     page=page,
                     _from=from_ts,
@@ -129,90 +257,130 @@ class GateTradeClient:
                     break
                 
                 for r in records:
+                    currencies.append(r.currency)
                     # 理财记录的时间戳是毫秒
-                    create_time_ms = int(r.create_time)
-                    create_time = create_time_ms // 1000
-                    
-                    all_records.append({
-                        "id": f"earn_{r.currency}_{create_time_ms}",
-                        "source": "earn",
-                        "create_time": create_time,
-                        "create_time_ms": create_time_ms,
-                        "currency_pair": f"{r.currency}_USDT",
-                        "base_currency": r.currency,
-                        "quote_currency": "USDT",
-                        "side": "earn",  # 理财记录标记为earn
-                        "role": "earn",
-                        "amount": float(r.amount),
-                        "price": 0,  # 理财记录没有价格
-                        "order_id": "",
-                        "fee": 0,
-                        "fee_currency": r.currency,
-                    })
+                    create_times_ms.append(int(r.create_time))
+                    amounts.append(float(r.amount))
                 
                 if len(records) < limit:
                     break
                 
                 page += 1
-                time.sleep(0.05)
                 
             except (ApiException, GateApiException) as e:
                 if "INVALID_PARAM_VALUE" not in str(e):
                     print(f"    获取理财记录失败: {e}")
                 break
         
-        return all_records
+        create_time_ms = np.asarray(create_times_ms, dtype=np.int64)
+        
+        return pd.DataFrame({
+            "id": [f"earn_{c}_{ms}" for c, ms in zip(currencies, create_times_ms)],
+            "source": "earn",
+            "create_time": create_time_ms // 1000,
+            "create_time_ms": create_time_ms,
+            "currency_pair": [f"{c}_USDT" for c in currencies],
+            "base_currency": currencies,
+            "quote_currency": "USDT",
+            "side": "earn",  # 理财记录标记为earn
+            "role": "earn",
+            "amount": np.asarray(amounts, dtype=np.float64),
+            "price": 0.0,  # 理财记录没有价格
+            "order_id": "",
+            "fee": 0.0,
+            "fee_currency": currencies,
+        })
     
-    def fetch_all_trades(self) -> list[dict]:
+    def iter_all_trades(self, min_ts: int | None = None) -> Iterator[pd.DataFrame]:
         """
-        获取所有历史成交记录
+        获取所有历史成交记录，逐个窗口返回
         
-        按30天为单位往前回溯，直到连续30天没有记录为止
+        按30天为单位往前回溯，直到连续30天没有记录为止；
+        如果已知最早成交时间 min_ts（来自检查点），则回溯到该时间即停止。
+        每批并发查询 FETCH_CONCURRENCY 个窗口（现货和理财同时查询），
+        整批完成后再按时间倒序检查是否已到达回溯终点。
+        每个有记录的窗口单独返回，调用方可以边拉取边保存，内存占用不随历史增长。
         """
-        all_trades = []
-        now = datetime.now()
-        window_end = now
+        total = 0
+        # 相邻窗口边界重叠，只需和上一个窗口的id比较去重
+        seen_ids = set()
+        window_end = datetime.now()
         empty_days = 0
+        done = False
         
-        print("正在获取历史成交记录（按30天窗口回溯）...")
+        if min_ts is None:
+            print("正在获取历史成交记录（按30天窗口回溯）...")
+        else:
+            print(f"正在获取历史成交记录（按30天窗口回溯至 {datetime.fromtimestamp(min_ts).strftime('%Y-%m-%d')}）...")
         print("=" * 60)
         
-        while empty_days < STOP_EMPTY_DAYS:
-            window_start = window_end - timedelta(days=QUERY_WINDOW_DAYS)
-            
-            from_ts = int(window_start.timestamp())
-            to_ts = int(window_end.timestamp())
-            
-            period = f"{window_start.strftime('%Y-%m-%d')} ~ {window_end.strftime('%Y-%m-%d')}"
-            print(f"查询: {period}")
-            
-            # 获取现货记录
-            spot_trades = self._fetch_spot_trades_in_range(from_ts, to_ts)
-            
-            # 获取理财记录
-            earn_records = self._fetch_earn_records_in_range(from_ts, to_ts)
-            
-            total_in_window = len(spot_trades) + len(earn_records)
-            print(f"  现货: {len(spot_trades)} 条, 理财: {len(earn_records)} 条")
-            
-            if total_in_window > 0:
-                all_trades.extend(spot_trades)
-                all_trades.extend(earn_records)
-                empty_days = 0  # 重置空窗计数
-            else:
-                empty_days += QUERY_WINDOW_DAYS
-                print(f"  (连续 {empty_days} 天无记录)")
-            
-            # 移动到上一个窗口
-            window_end = window_start
-            time.sleep(0.1)
+        with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+            while not done:
+                # 预先计算本批次的窗口
+                windows = []
+                for _ in range(FETCH_CONCURRENCY):
+                    window_start = window_end - timedelta(days=QUERY_WINDOW_DAYS)
+                    windows.append((window_start, window_end))
+                    window_end = window_start
+                    if min_ts is not None and window_start.timestamp() <= min_ts:
+                        break
+                
+                futures = []
+                for start, end in windows:
+                    from_ts = int(start.timestamp())
+                    to_ts = int(end.timestamp())
+                    futures.append((
+                        executor.submit(self._fetch_spot_trades_in_range, from_ts, to_ts),
+                        executor.submit(self._fetch_earn_records_in_range, from_ts, to_ts),
+                    ))
+                
+                # 按时间倒序处理结果，与逐个窗口查询时的停止条件保持一致
+                for (start, end), (spot_future, earn_future) in zip(windows, futures):
+                    spot_trades = spot_future.result()
+                    earn_records = earn_future.result()
+                    
+                    period = f"{start.strftime('%Y-%m-%d')} ~ {end.strftime('%Y-%m-%d')}"
+                    print(f"查询: {period}")
+                    
+                    total_in_window = len(spot_trades) + len(earn_records)
+                    print(f"  现货: {len(spot_trades)} 条, 理财: {len(earn_records)} 条")
+                    
+                    if total_in_window > 0:
+                        window_frames = []
+                        window_ids = set()
+                        for frame in (spot_trades, earn_records):
+                            ids = frame["id"].to_numpy()
+                            is_new = np.fromiter((i not in seen_ids for i in ids), dtype=bool, count=len(ids))
+                            window_ids.update(ids)
+                            if is_new.any():
+                                window_frames.append(frame[is_new])
+                        seen_ids = window_ids
+                        
+                        if window_frames:
+                            window_df = pd.concat(window_frames, ignore_index=True)
+                            total += len(window_df)
+                            yield window_df
+                        empty_days = 0  # 重置空窗计数
+                    else:
+                        empty_days += QUERY_WINDOW_DAYS
+                        print(f"  (连续 {empty_days} 天无记录)")
+                    
+                    if min_ts is not None:
+                        done = start.timestamp() <= min_ts
+                    else:
+                        done = empty_days >= STOP_EMPTY_DAYS
+                    
+                    if done:
+                        # 已到达回溯终点，本批次更早的窗口不再处理
+                        for pending in futures:
+                            for future in pending:
+                                future.cancel()
+                        break
         
         print("=" * 60)
-        print(f"完成！共获取 {len(all_trades)} 条记录")
-        
-        return all_trades
+        print(f"完成！共获取 {total} 条记录")
     
-    def fetch_trades_since(self, from_time: int) -> list[dict]:
+    def fetch_trades_since(self, from_time: int) -> pd.DataFrame:
         """
         获取指定时间之后的成交记录（增量更新）
         """
@@ -220,55 +388,306 @@ class GateTradeClient:
         
         print(f"正在获取 {datetime.fromtimestamp(from_time)} 之后的成交记录...")
         
-        spot_trades = self._fetch_spot_trades_in_range(from_time, now)
-        earn_records = self._fetch_earn_records_in_range(from_time, now)
+        # 现货和理财查询互不依赖，并发执行
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            spot_future = executor.submit(self._fetch_spot_trades_in_range, from_time, now)
+            earn_future = executor.submit(self._fetch_earn_records_in_range, from_time, now)
+            spot_trades, earn_records = spot_future.result(), earn_future.result()
         
-        all_trades = spot_trades + earn_records
+        frames = [f for f in (spot_trades, earn_records) if not f.empty]
+        all_trades = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
         print(f"获取到 {len(spot_trades)} 条现货, {len(earn_records)} 条理财记录")
         
         return all_trades
 
 
 class TradeDataManager:
-    """交易数据管理器"""
-    
-    def __init__(self, trades_csv: Path = TRADES_CSV):
-        self.trades_csv = trades_csv
+    """
+    交易数据管理器
     
-    def load(self) -> pd.DataFrame:
-        """加载本地缓存的成交记录"""
-        if self.trades_csv.exists():
-            return pd.read_csv(self.trades_csv)
-        return pd.DataFrame()
+    成交记录按月分区存储，增量更新只读写受影响的月份分区，
+    查询时通过过滤条件和列裁剪只扫描需要的数据。
+    """
     
-    def save(self, df: pd.DataFrame) -> None:
-        """保存成交记录到CSV"""
-        df.to_csv(self.trades_csv, index=False)
-        print(f"已保存 {len(df)} 条成交记录到 {self.trades_csv}")
+    def __init__(self, trades_dir: Path = TRADES_DIR, checkpoint_path: Path = CHECKPOINT_JSON):
+        self.trades_dir = trades_dir
+        self.checkpoint_path = checkpoint_path
+        self.partitioning = ds.partitioning(TRADES_PARTITION_SCHEMA, flavor="hive")
+        self.schema = pa.unify_schemas([TRADES_SCHEMA, TRADES_PARTITION_SCHEMA])
     
-    def get_last_trade_time(self, df: pd.DataFrame) -> int | None:
-        """获取最后一条记录的时间戳"""
+    @staticmethod
+    def to_categorical(df: pd.DataFrame) -> pd.DataFrame:
+        """将低基数字符串列转换为 category 类型，币种列共用同一组类别"""
         if df.empty:
+            return df
+        
+        df = df.copy()
+        for col in CATEGORY_COLUMNS:
+            if col in df:
+                df[col] = df[col].astype("category")
+        
+        currency_columns = [col for col in CURRENCY_COLUMNS if col in df]
+        currencies = set()
+        for col in currency_columns:
+            currencies.update(df[col].dropna().unique())
+        currency_dtype = pd.CategoricalDtype(sorted(currencies))
+        for col in currency_columns:
+            df[col] = df[col].astype(currency_dtype)
+        
+        return df
+    
+    def exists(self) -> bool:
+        """本地是否已有成交记录缓存"""
+        return self.trades_dir.exists() and any(self.trades_dir.rglob("*.parquet"))
+    
+    def migrate_legacy(self) -> None:
+        """将旧版本的单文件缓存迁移为按月分区的数据集"""
+        if self.exists():
+            return
+        
+        for legacy_path in LEGACY_TRADES_FILES:
+            if legacy_path.exists():
+                print(f"从旧版缓存迁移: {legacy_path}")
+                if legacy_path.suffix == ".csv":
+                    # 纯数字的 order_id 会被推断成整数/浮点数，按字符串读取；理财记录的 order_id 为空
+                    legacy_df = pd.read_csv(legacy_path, dtype={"id": str, "order_id": str})
+                    legacy_df["order_id"] = legacy_df["order_id"].fillna("")
+                else:
+                    legacy_df = pd.read_parquet(legacy_path)
+                self.save(self._normalize_legacy_ids(legacy_df))
+                break
+        else:
+            return
+        
+        # 迁移完成后重命名旧文件，之后删除 data/trades 目录会触发全量拉取，而不是再次导入旧数据
+        for legacy_path in LEGACY_TRADES_FILES:
+            if legacy_path.exists():
+                legacy_path.rename(legacy_path.with_suffix(legacy_path.suffix + ".migrated"))
+    
+    @staticmethod
+    def _normalize_legacy_ids(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        将旧版缓存中的 id/order_id 统一为字符串
+        
+        旧版由 CSV 迁移来的单文件 Parquet 中，order_id 可能是整数或浮点数（如 456.0），
+        写入 TRADES_SCHEMA 前需还原为 "456"，空值还原为 ""
+        """
+        df = df.copy()
+        for col in ("id", "order_id"):
+            if pd.api.types.is_numeric_dtype(df[col]):
+                values = df[col].astype("Int64")
+                df[col] = values.astype(str).where(values.notna(), "")
+            else:
+                df[col] = df[col].fillna("").astype(str)
+        return df
+    
+    def count(self) -> int:
+        """本地缓存的记录数（只读取 Parquet 元数据）"""
+        if not self.exists():
+            return 0
+        return self._dataset().count_rows()
+    
+    def load(self, columns: list[str] | None = None, filter: pc.Expression | None = None) -> pd.DataFrame:
+        """
+        加载本地缓存的成交记录
+        
+        columns 和 filter 会下推到 Parquet 扫描，分区字段上的过滤可跳过整个月份目录
+        """
+        if not self.exists():
+            return pd.DataFrame()
+        
+        if columns is None:
+            columns = TRADES_SCHEMA.names
+        
+        df = self._dataset().to_table(columns=columns, filter=filter).to_pandas()
+        return self.to_categorical(df)
+    
+    def _dataset(self) -> ds.Dataset:
+        """打开成交记录数据集，各文件按统一的存储结构读取"""
+        return ds.dataset(self.trades_dir, schema=self.schema, format="parquet", partitioning=self.partitioning)
+    
+    def load_checkpoint(self) -> dict | None:
+        """读取检查点（earliest_ts / latest_ts）"""
+        if not self.checkpoint_path.exists():
             return None
-        return int(df["create_time"].max())
+        return json.loads(self.checkpoint_path.read_text())
+    
+    def _update_checkpoint(self, earliest_ts: int, latest_ts: int) -> None:
+        """用新保存记录的时间范围更新检查点中的最早/最晚成交时间"""
+        checkpoint = self.load_checkpoint()
+        if checkpoint is not None:
+            earliest_ts = min(earliest_ts, checkpoint["earliest_ts"])
+            latest_ts = max(latest_ts, checkpoint["latest_ts"])
+        
+        self.checkpoint_path.write_text(json.dumps({"earliest_ts": earliest_ts, "latest_ts": latest_ts}))
+    
+    def get_last_trade_time(self) -> int | None:
+        """获取最后一条记录的时间戳（只读取最新月份分区的 create_time 列）"""
+        partitions = sorted(self.trades_dir.glob("year=*/month=*"))
+        if not partitions:
+            return None
+        
+        table = ds.dataset(partitions[-1], format="parquet").to_table(columns=["create_time"])
+        return int(pc.max(table["create_time"]).as_py())
+    
+    def save(self, new_df: pd.DataFrame) -> int:
+        """保存新的成交记录，并更新检查点，返回实际新增的记录数"""
+        if new_df.empty:
+            return 0
+        
+        added = self._write(new_df)
+        if added:
+            self._update_checkpoint(int(new_df["create_time"].min()), int(new_df["create_time"].max()))
+        return added
+    
+    def save_backfill(self, frames: Iterable[pd.DataFrame]) -> None:
+        """
+        全量拉取时边拉取边保存
+        
+        先写入临时目录，全部窗口完成后再替换正式数据集并更新检查点。
+        中途中断不会留下只有部分历史的缓存，否则下次运行会误以为缓存完整而只做增量更新。
+        """
+        staging = TradeDataManager(self.trades_dir.with_name(f"{self.trades_dir.name}.staging"), self.checkpoint_path)
+        if staging.trades_dir.exists():
+            shutil.rmtree(staging.trades_dir)
+        
+        earliest_ts = latest_ts = None
+        for df in frames:
+            if df.empty:
+                continue
+            staging._write(df)
+            window_min, window_max = int(df["create_time"].min()), int(df["create_time"].max())
+            earliest_ts = window_min if earliest_ts is None else min(earliest_ts, window_min)
+            latest_ts = window_max if latest_ts is None else max(latest_ts, window_max)
+        
+        if earliest_ts is None:
+            return
+        
+        if self.trades_dir.exists():
+            shutil.rmtree(self.trades_dir)
+        staging.trades_dir.rename(self.trades_dir)
+        self._update_checkpoint(earliest_ts, latest_ts)
+        print(f"全量数据已保存到 {self.trades_dir}")
+    
+    def _write(self, new_df: pd.DataFrame) -> int:
+        """
+        只读取新记录所在的月份分区，合并去重后整体重写这些分区，其余分区不受影响
+        
+        返回实际新增的记录数，全部已缓存时不重写分区
+        """
+        new_df = self._with_partition_keys(new_df)
+        
+        months = new_df[["year", "month"]].drop_duplicates().itertuples(index=False, name=None)
+        month_filter = None
+        for year, month in months:
+            expr = (pc.field("year") == year) & (pc.field("month") == month)
+            month_filter = expr if month_filter is None else month_filter | expr
+        
+        cached_df = self.load(filter=month_filter)
+        combined_df = self.merge_trades(cached_df, new_df.drop(columns=["year", "month"]))
+        added = len(combined_df) - len(cached_df)
+        if added == 0:
+            return 0
+        
+        combined_df = self._with_partition_keys(combined_df)
+        
+        ds.write_dataset(
+            pa.Table.from_pandas(combined_df[self.schema.names], schema=self.schema, preserve_index=False),
+            self.trades_dir,
+            format="parquet",
+            file_options=ds.ParquetFileFormat().make_write_options(compression=PARQUET_COMPRESSION),
+            partitioning=self.partitioning,
+            basename_template="part-{i}.parquet",
+            existing_data_behavior="delete_matching",
+        )
+        print(f"已保存 {added} 条新成交记录到 {self.trades_dir}")
+        return added
     
-    def merge_trades(self, cached_df: pd.DataFrame, new_trades: list[dict]) -> pd.DataFrame:
-        """合并新旧成交记录并去重"""
-        if not new_trades:
+    @staticmethod
+    def _with_partition_keys(df: pd.DataFrame) -> pd.DataFrame:
+        """根据 create_time 添加 year/month 分区字段（UTC）"""
+        dt = pd.to_datetime(df["create_time"], unit="s")
+        return df.assign(
+            year=dt.dt.strftime("%Y"),
+            month=dt.dt.strftime("%m"),
+        )
+    
+    def merge_trades(self, cached_df: pd.DataFrame, new_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        合并新旧成交记录并去重
+        
+        缓存中的id本身已唯一，只需剔除新记录中已缓存的id，
+        无需对全部历史记录重新去重。
+        """
+        if new_df.empty:
             return cached_df
         
-        new_df = pd.DataFrame(new_trades)
+        # 新记录内部可能有重复（相邻查询窗口边界重叠）
+        new_df = new_df.drop_duplicates(subset=["id"], keep="last")
         
         if cached_df.empty:
-            combined_df = new_df
+            combined_df = new_df.sort_values("create_time", kind="mergesort").reset_index(drop=True)
         else:
-            combined_df = pd.concat([cached_df, new_df], ignore_index=True)
-            # 按id去重，保留最新的
-            combined_df = combined_df.drop_duplicates(subset=["id"], keep="last")
+            mask = ~new_df["id"].isin(cached_df["id"].to_numpy())
+            new_df = new_df[mask].sort_values("create_time", kind="mergesort")
+            combined_df = self._merge_sorted(cached_df, new_df)
+        
+        # 新旧记录的类别不同，合并后重新统一类别
+        return self.to_categorical(combined_df)
+    
+    @staticmethod
+    def _merge_sorted(cached_df: pd.DataFrame, new_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        按 create_time 归并两个有序的 DataFrame
+        
+        缓存按时间有序写入，新记录通常很少，用二分查找确定新记录的插入位置，
+        整体为线性复杂度，无需对合并结果重新排序。时间相同时缓存记录在前。
+        """
+        if not cached_df["create_time"].is_monotonic_increasing:
+            cached_df = cached_df.sort_values("create_time", kind="mergesort")
+        
+        n_cached, n_new = len(cached_df), len(new_df)
+        insert_pos = np.searchsorted(
+            cached_df["create_time"].to_numpy(), new_df["create_time"].to_numpy(), side="right"
+        )
+        
+        # 新记录在结果中的位置 = 插入点 + 排在它前面的新记录数
+        is_new = np.zeros(n_cached + n_new, dtype=bool)
+        is_new[insert_pos + np.arange(n_new)] = True
         
-        # 按时间排序
-        combined_df = combined_df.sort_values("create_time").reset_index(drop=True)
-        return combined_df
+        order = np.empty(n_cached + n_new, dtype=np.intp)
+        order[~is_new] = np.arange(n_cached)
+        order[is_new] = np.arange(n_cached, n_cached + n_new)
+        
+        combined_df = pd.concat([cached_df, new_df], ignore_index=True)
+        return combined_df.take(order).reset_index(drop=True)
+
+
+@functools.cache
+def _load_net_amount_cost_kernel():
+    """
+    按需导入 numba 并编译手续费调整内核，未安装 numba 时返回 None
+    
+    numba 为可选依赖，导入本身就有明显开销，只在记录数达到阈值时才加载
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+    
+    @njit(parallel=True, cache=True)
+    def net_amount_cost_kernel(price, amount, fee, fee_currency, base_currency, quote_currency):
+        """一次遍历计算净买入数量和净买入金额，不分配中间的 cost 数组"""
+        n = price.shape[0]
+        net_amount = np.empty(n)
+        net_cost = np.empty(n)
+        for i in prange(n):
+            cost = price[i] * amount[i]
+            net_amount[i] = amount[i] - fee[i] if fee_currency[i] == base_currency[i] else amount[i]
+            net_cost[i] = cost - fee[i] if fee_currency[i] == quote_currency[i] else cost
+        return net_amount, net_cost
+    
+    return net_amount_cost_kernel
 
 
 class TradeAnalyzer:
@@ -286,36 +705,51 @@ class TradeAnalyzer:
         if df.empty:
             return pd.DataFrame()
         
+        # 币种列需要是共用同一组类别的 category 类型，整数编码才能直接比较
+        dtypes = [df[col].dtype for col in CURRENCY_COLUMNS]
+        if not all(isinstance(d, pd.CategoricalDtype) and d.categories.equals(dtypes[0].categories) for d in dtypes):
+            df = TradeDataManager.to_categorical(df)
+        
         # 只统计现货买入记录（side=buy）
-        buy_df = df[df["side"] == "buy"].copy()
+        is_buy = (df["side"] == "buy").to_numpy()
         
-        if buy_df.empty:
+        if not is_buy.any():
             print("没有现货买入记录")
             return pd.DataFrame()
         
-        # 计算每笔交易的金额
-        buy_df["cost"] = buy_df["price"] * buy_df["amount"]
-        
-        # 计算净买入数量（扣除用基础货币支付的手续费）
-        # 如果 fee_currency == base_currency，则从 amount 中扣除 fee
-        buy_df["net_amount"] = buy_df.apply(
-            lambda row: row["amount"] - row["fee"] if row["fee_currency"] == row["base_currency"] else row["amount"],
-            axis=1
-        )
-        
-        # 如果手续费用计价货币支付，则从 cost 中扣除
-        buy_df["net_cost"] = buy_df.apply(
-            lambda row: row["cost"] - row["fee"] if row["fee_currency"] == row["quote_currency"] else row["cost"],
-            axis=1
-        )
+        # 过滤、手续费调整和分组求和都直接在 numpy 数组上完成，不创建中间 DataFrame
+        # 币种列类别相同，直接比较整数编码
+        base_currency = df["base_currency"].cat.codes.to_numpy()[is_buy]
+        quote_currency = df["quote_currency"].cat.codes.to_numpy()[is_buy]
+        fee_currency = df["fee_currency"].cat.codes.to_numpy()[is_buy]
+        amount = df["amount"].to_numpy()[is_buy]
+        fee = df["fee"].to_numpy()[is_buy]
+        price = df["price"].to_numpy()[is_buy]
+        
+        kernel = _load_net_amount_cost_kernel() if len(amount) >= NUMBA_MIN_ROWS else None
+        if kernel is not None:
+            net_amount, net_cost = kernel(price, amount, fee, fee_currency, base_currency, quote_currency)
+        else:
+            # 计算每笔交易的金额
+            cost = price * amount
+            
+            # 计算净买入数量（扣除用基础货币支付的手续费）
+            # 如果 fee_currency == base_currency，则从 amount 中扣除 fee
+            net_amount = np.where(fee_currency == base_currency, amount - fee, amount)
+            
+            # 如果手续费用计价货币支付，则从 cost 中扣除
+            net_cost = np.where(fee_currency == quote_currency, cost - fee, cost)
         
-        # 按基础货币分组统计
-        stats = buy_df.groupby("base_currency").agg({
-            "net_amount": "sum",
-            "net_cost": "sum",
-        }).reset_index()
+        # 按基础货币编码分组统计
+        currencies = df["base_currency"].cat.categories
+        n_currencies = len(currencies)
+        has_buy = np.bincount(base_currency, minlength=n_currencies) > 0
         
-        stats.columns = ["currency", "total_amount", "total_cost"]
+        stats = pd.DataFrame({
+            "currency": np.asarray(currencies, dtype=object)[has_buy],
+            "total_amount": np.bincount(base_currency, weights=net_amount, minlength=n_currencies)[has_buy],
+            "total_cost": np.bincount(base_currency, weights=net_cost, minlength=n_currencies)[has_buy],
+        })
         
         # 计算均价
         stats["avg_price"] = stats["total_cost"] / stats["total_amount"]
@@ -337,33 +771,57 @@ class TradeAnalyzer:
         print(f"{'币种':<10} {'买入数量':>8} {'买入金额(USDT)':>18} {'平均价格':>8}")
         print(f"{'-' * 60}")
         
-        for _, row in stats.iterrows():
-            print(f"{row['currency']:<10} {row['total_amount']:>15.5f} {row['total_cost']:>18.2f} {row['avg_price']:>15.6f}")
+        rows = stats[["currency", "total_amount", "total_cost", "avg_price"]].itertuples(index=False, name=None)
+        lines = [f"{c:<10} {a:>15.5f} {t:>18.2f} {p:>15.6f}" for c, a, t, p in rows]
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
         
         print(f"{'=' * 60}")
         print(f"  总计: {len(stats)} 个币种，总买入金额: {stats['total_cost'].sum():.2f} USDT")
         print(f"{'=' * 60}")
     
     @staticmethod
-    def save_daily_stats(stats: pd.DataFrame, output_path: Path = DAILY_STATS_CSV) -> None:
-        """保存每日统计到CSV"""
+    def has_daily_stats(date: str, output_dir: Path = DAILY_STATS_DIR) -> bool:
+        """指定日期的统计是否已保存（只检查分区目录是否存在）"""
+        return (output_dir / f"date={date}").exists()
+    
+    @staticmethod
+    def save_daily_stats(stats: pd.DataFrame, output_dir: Path = DAILY_STATS_DIR) -> None:
+        """
+        保存每日统计
+        
+        按日期分区写入，只重写今天的分区，不需要读取历史统计
+        """
         today = datetime.now().strftime("%Y-%m-%d")
         
         # 添加日期列
         daily_stats = stats.copy()
         daily_stats.insert(0, "date", today)
         
-        # 追加到文件
-        if output_path.exists():
-            existing_df = pd.read_csv(output_path)
-            # 删除今天已有的记录（避免重复）
-            existing_df = existing_df[existing_df["date"] != today]
-            combined_df = pd.concat([existing_df, daily_stats], ignore_index=True)
-        else:
-            combined_df = daily_stats
+        if not output_dir.exists():
+            # 首次写入时迁移旧版本的单文件统计
+            for legacy_path in LEGACY_DAILY_STATS_FILES:
+                if legacy_path.exists():
+                    print(f"从旧版统计文件迁移: {legacy_path}")
+                    if legacy_path.suffix == ".csv":
+                        legacy_df = pd.read_csv(legacy_path)
+                    else:
+                        legacy_df = pd.read_parquet(legacy_path)
+                    legacy_df = legacy_df[legacy_df["date"] != today]
+                    daily_stats = pd.concat([legacy_df, daily_stats], ignore_index=True)
+                    break
         
-        combined_df.to_csv(output_path, index=False)
-        print(f"统计结果已保存到 {output_path}")
+        # 只删除并重写本次涉及的日期分区（避免重复）
+        ds.write_dataset(
+            pa.Table.from_pandas(daily_stats, preserve_index=False),
+            output_dir,
+            format=ds.ParquetFileFormat(),
+            file_options=ds.ParquetFileFormat().make_write_options(compression=PARQUET_COMPRESSION),
+            partitioning=ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive"),
+            basename_template="part-{i}.parquet",
+            existing_data_behavior="delete_matching",
+        )
+        print(f"统计结果已保存到 {output_dir}")
 
 
 def main():
@@ -378,30 +836,36 @@ def main():
     data_manager = TradeDataManager()
     analyzer = TradeAnalyzer()
     
-    # 1. 加载本地缓存
-    cached_df = data_manager.load()
+    # 1. 检查本地缓存
+    data_manager.migrate_legacy()
+    from_time = data_manager.get_last_trade_time()
     
-    if cached_df.empty:
+    if from_time is None:
         print("本地无缓存，开始全量拉取...")
-        new_trades = client.fetch_all_trades()
+        checkpoint = data_manager.load_checkpoint()
+        # 2. 边拉取边保存，每个窗口只重写其所在的月份分区
+        data_manager.save_backfill(client.iter_all_trades(min_ts=checkpoint["earliest_ts"] if checkpoint else None))
     else:
-        print(f"本地已有 {len(cached_df)} 条记录")
-        from_time = data_manager.get_last_trade_time(cached_df)
+        print(f"本地已有 {data_manager.count()} 条记录")
         print(f"最后记录时间: {datetime.fromtimestamp(from_time)}")
-        new_trades = client.fetch_trades_since(from_time)
+        new_df = client.fetch_trades_since(from_time)
+        
+        # 2. 合并并保存（只重写新记录所在的月份分区）
+        # 查询起点包含最后一条已缓存记录，按实际新增的记录数判断是否有新成交
+        if data_manager.save(new_df) == 0:
+            print("没有新的成交记录")
+            # 没有新记录且今天已统计过，结果不会变化，无需重新计算
+            if analyzer.has_daily_stats(datetime.now().strftime("%Y-%m-%d")):
+                print("今日统计已是最新，跳过计算")
+                return
     
-    # 2. 合并并保存
-    df = data_manager.merge_trades(cached_df, new_trades)
+    # 只读取买入记录和计算所需的列
+    df = data_manager.load(columns=ANALYSIS_COLUMNS, filter=pc.field("side") == "buy")
     
-    if df.empty:
+    if df.empty and not data_manager.exists():
         print("没有找到任何成交记录")
         return
     
-    if new_trades or cached_df.empty:
-        data_manager.save(df)
-    else:
-        print("没有新的成交记录")
-    
     # 3. 计算均价（只统计现货买入）
     stats = analyzer.calculate_avg_price(df)
     